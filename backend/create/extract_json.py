@@ -1,80 +1,282 @@
 import requests
 import json
+import os
+import re
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
+from requests.adapters import HTTPAdapter
 
-def extract_kg_entities_with_gemma(content, pmc_id):
-    """Use Gemma to extract all knowledge graph entities from paper content"""
-    
-    prompt = f"""Extract key information from this biology paper. Return ONLY valid JSON in this exact format:
+try:
+    import orjson
+    json_loads = orjson.loads
+    def json_dumps(obj):
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+except ImportError:
+    json_loads = json.loads
+    def json_dumps(obj):
+        return json.dumps(obj, indent=2).encode('utf-8')
+
+# Maximum number of papers packed into one Gemma prompt
+BATCH_SIZE = 4
+# gemma2 context length, sent as a fixed num_ctx so Ollama never reloads the model
+# for a different context size; prompts beyond it are silently truncated
+MAX_CONTEXT_TOKENS = 8192
+# Conservative token estimates for scientific text and for one KG JSON object
+CHARS_PER_TOKEN = 3
+OUTPUT_TOKENS_PER_PAPER = 768
+# Number of concurrent Gemma requests. Keep it at or below the server's
+# OLLAMA_NUM_PARALLEL (default 4): requests queued inside Ollama count against
+# the read timeout, and read timeouts are not retried
+MAX_WORKERS = int(os.environ.get('OLLAMA_NUM_PARALLEL', 4))
+# Extra attempts for a Gemma request that fails to connect (read timeouts are not retried)
+MAX_RETRIES = 2
 
-{{
-  "publication": {{
+# Pooled HTTP session so Ollama calls reuse connections; sized for the worker pool
+_SESSION = requests.Session()
+_SESSION.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=MAX_WORKERS))
+
+# Character budgets for the text sent to Gemma
+FRONT_MATTER_CHARS = 500
+SECTIONS_CHARS = 3000
+MAX_TITLE_CHARS = 300
+MAX_AUTHORS = 20
+
+# Section headings on a line of their own, optionally numbered ("2. Materials and Methods")
+SECTION_HEADER_RE = re.compile(
+    r'^[ \t]*(?:\d+(?:\.\d+)*\.?[ \t]*)?'
+    r'(abstract|introduction|background|materials and methods|methods|results|'
+    r'discussion|conclusions?|references|acknowledge?ments?)[ \t]*:?[ \t]*$',
+    re.IGNORECASE | re.MULTILINE)
+# The PMC identifier line closes the front matter when there is no Abstract heading
+PMCID_LINE_RE = re.compile(r'^PMCID:.*$', re.MULTILINE)
+
+KG_SCHEMA = """{
+  "publication": {
     "pmc_id": "PMC1234567",
     "title": "paper title",
     "year": "YYYY",
     "journal": "journal name"
-  }},
+  },
   "authors": ["author1", "author2"],
-  "subjects": {{
+  "subjects": {
     "species": ["species1", "species2"],
     "tissues": ["tissue1", "tissue2"]
-  }},
-  "methods": {{
+  },
+  "methods": {
     "platforms": ["platform1", "platform2"],
     "assays": ["assay_type1", "assay_type2"]
-  }},
+  },
   "treatments": [
-    {{
+    {
       "agent": "treatment_agent",
       "dose": "dose_amount dose_unit",
       "duration": "duration_amount duration_unit"
-    }}
+    }
   ],
   "results": [
-    {{
+    {
       "target": "measured_target",
       "effect": "observed_effect",
       "magnitude": "effect_size"
-    }}
+    }
   ]
-}}
+}"""
+
+def _summarize_front_matter(front):
+    """Reduce the scraped PMC header to citation, title and author names"""
+    lines = [line.strip() for line in front.splitlines()]
+    if 'Search in PMC' not in lines or 'Add to search' not in lines:
+        return front[:FRONT_MATTER_CHARS]
+    
+    # Citation (journal, year) precedes the PMC navigation links
+    citation = lines[:lines.index('Search in PMC')]
+    
+    # Title follows the links and ends where the first author name is repeated
+    title_lines = []
+    rest = lines[lines.index('Add to search') + 1:]
+    for i, line in enumerate(rest):
+        if not line or (i + 1 < len(rest) and rest[i + 1] == line):
+            break
+        title_lines.append(line)
+    title = ' '.join(title_lines)[:MAX_TITLE_CHARS]
+    
+    authors = re.findall(r'^Find articles by (.+)$', front, re.MULTILINE)[:MAX_AUTHORS]
+    return '\n'.join(citation + [f"Title: {title}", f"Authors: {', '.join(authors)}"])
+
+def _extract_relevant_sections(text):
+    """Trim a paper to its citation, title and authors plus Abstract, Methods and Results"""
+    matches = list(SECTION_HEADER_RE.finditer(text))
+    
+    sections = []
+    seen = set()
+    for i, match in enumerate(matches):
+        heading = match.group(1).lower()
+        if heading.endswith('methods'):
+            heading = 'methods'
+        # Keep only the first occurrence; later hits are usually table or figure labels
+        if heading not in ('abstract', 'methods', 'results') or heading in seen:
+            continue
+        seen.add(heading)
+        end = matches[i + 1].start() if i + 1 < len(matches) else len(text)
+        sections.append(text[match.start():end])
+    
+    if 'abstract' in seen:
+        front_end = next(m.start() for m in matches if m.group(1).lower() == 'abstract')
+    else:
+        pmcid_line = PMCID_LINE_RE.search(text)
+        front_end = pmcid_line.end() if pmcid_line else 0
+    
+    # Without Methods/Results headings, send the body from the Abstract on instead
+    if 'methods' not in seen and 'results' not in seen:
+        sections = [text[front_end:].strip()]
+    
+    # Share one budget across sections: short ones keep their full text and
+    # the remainder is split evenly among the longer ones
+    allowance = {}
+    remaining = SECTIONS_CHARS
+    by_length = sorted(range(len(sections)), key=lambda i: len(sections[i]))
+    for n, i in enumerate(by_length):
+        allowance[i] = min(len(sections[i]), remaining // (len(sections) - n))
+        remaining -= allowance[i]
+    
+    parts = [_summarize_front_matter(text[:front_end])]
+    parts.extend(section[:allowance[i]] for i, section in enumerate(sections))
+    return '\n'.join(parts)
+
+def _estimate_tokens(text):
+    return len(text) // CHARS_PER_TOKEN + 1
+
+def generate_with_gemma(prompt, timeout=60):
+    """Send a prompt to Gemma and return the raw response text, or None on HTTP error"""
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            response = _SESSION.post('http://localhost:11434/api/generate',
+                                   json={
+                                       'model': 'gemma2:2b',
+                                       'prompt': prompt,
+                                       'stream': False,
+                                       'options': {
+                                           'temperature': 0.1,
+                                           'top_p': 0.9,
+                                           'num_ctx': MAX_CONTEXT_TOKENS
+                                       }
+                                   },
+                                   timeout=timeout)
+            break
+        except requests.ConnectionError:
+            if attempt == MAX_RETRIES:
+                raise
+            time.sleep(2 ** attempt)  # Back off before retrying
+    
+    if response.status_code == 200:
+        result = json_loads(response.content)
+        return result.get('response', '').strip()
+    return None
+
+def extract_kg_entities_with_gemma(content, pmc_id):
+    """Use Gemma to extract all knowledge graph entities from paper content"""
+    
+    prompt = f"""Extract key information from this biology paper. Return ONLY valid JSON in this exact format:
+
+{KG_SCHEMA}
 
 Text:
-{content[:8000]}
+{_extract_relevant_sections(content)}
 
 JSON:"""
 
     try:
-        response = requests.post('http://localhost:11434/api/generate',
-                               json={
-                                   'model': 'gemma2:2b',
-                                   'prompt': prompt,
-                                   'stream': False,
-                                   'options': {
-                                       'temperature': 0.1,
-                                       'top_p': 0.9
-                                   }
-                               },
-                               timeout=60)
+        response_text = generate_with_gemma(prompt)
         
-        if response.status_code == 200:
-            result = response.json()
-            response_text = result.get('response', '').strip()
-            
+        if response_text:
             # Extract JSON from response
             json_start = response_text.find('{')
             json_end = response_text.rfind('}') + 1
             if json_start != -1 and json_end > json_start:
                 json_text = response_text[json_start:json_end]
-                return json.loads(json_text)
+                return json_loads(json_text)
             
     except Exception as e:
         print(f"Error with Gemma for {pmc_id}: {e}")
     
     return None
 
-def process_files_to_json(input_dir, output_dir):
+def extract_kg_entities_batch(contents):
+    """Extract knowledge graph entities for several papers in one Gemma call
+    
+    Takes a list of (pmc_id, content) tuples and returns a dict mapping
+    pmc_id to its KG data. Papers missing from the response are omitted.
+    """
+    papers_text = ""
+    for i, (pmc_id, content) in enumerate(contents, 1):
+        papers_text += f"Paper {i} ({pmc_id}):\n{_extract_relevant_sections(content)}\n\n"
+    
+    prompt = f"""Extract key information from each of these {len(contents)} biology papers. Return ONLY a valid JSON array with one object per paper, in the same order as the papers. Each object must use this exact format, with "pmc_id" set to the paper's ID:
+
+{KG_SCHEMA}
+
+{papers_text}JSON:"""
+
+    pmc_ids = [pmc_id for pmc_id, _ in contents]
+    try:
+        response_text = generate_with_gemma(prompt, timeout=60 * len(contents))
+        
+        if response_text:
+            # Extract JSON array from response
+            json_start = response_text.find('[')
+            json_end = response_text.rfind(']') + 1
+            if json_start != -1 and json_end > json_start:
+                kg_list = json_loads(response_text[json_start:json_end])
+                
+                results = {}
+                for i, kg_data in enumerate(kg_list):
+                    if not isinstance(kg_data, dict):
+                        continue
+                    pmc_id = (kg_data.get('publication') or {}).get('pmc_id')
+                    # Fall back to position when the model didn't echo a usable ID
+                    if pmc_id not in pmc_ids and len(kg_list) == len(pmc_ids):
+                        pmc_id = pmc_ids[i]
+                    if pmc_id in pmc_ids and pmc_id not in results:
+                        results[pmc_id] = kg_data
+                return results
+            
+    except Exception as e:
+        print(f"Error with Gemma for batch {', '.join(pmc_ids)}: {e}")
+    
+    return {}
+
+def _batches_within_context(papers):
+    """Group (pmc_id, content) pairs so each packed prompt and its output fit in the context"""
+    overhead = _estimate_tokens(KG_SCHEMA) + 200  # Instructions and paper labels
+    batches = []
+    batch = []
+    batch_tokens = overhead
+    for pmc_id, content in papers:
+        tokens = _estimate_tokens(_extract_relevant_sections(content)) + OUTPUT_TOKENS_PER_PAPER
+        if batch and (len(batch) >= BATCH_SIZE or batch_tokens + tokens > MAX_CONTEXT_TOKENS):
+            batches.append(batch)
+            batch = []
+            batch_tokens = overhead
+        batch.append((pmc_id, content))
+        batch_tokens += tokens
+    if batch:
+        batches.append(batch)
+    return batches
+
+def extract_kg_entities_for_batch(batch):
+    """Extract KG data for a batch, falling back to single-paper calls for any misses"""
+    batch_results = extract_kg_entities_batch(batch) if len(batch) > 1 else {}
+    
+    results = []
+    for pmc_id, content in batch:
+        kg_data = batch_results.get(pmc_id)
+        if kg_data is None:
+            kg_data = extract_kg_entities_with_gemma(content, pmc_id)
+        results.append((pmc_id, kg_data))
+    return results
+
+def process_files_to_json(input_dir, output_dir, max_workers=MAX_WORKERS):
     """Process files using Gemma to extract JSON data"""
     input_path = Path(input_dir)
     output_path = Path(output_dir)
@@ -85,42 +287,61 @@ def process_files_to_json(input_dir, output_dir):
     
     processed = 0
     skipped_files = []
-
+    
+    pending = []
     for file_path in txt_files:
+        pmc_id = file_path.stem
+        
+        # Check if JSON file already exists
+        json_file = output_path / f'{pmc_id}_kg.json'
+        if not json_file.exists():
+            pending.append(file_path)
+
+    papers = []
+    for file_path in pending:
         try:
-            pmc_id = file_path.stem
-            
-            # Check if JSON file already exists
-            json_file = output_path / f'{pmc_id}_kg.json'
-            if json_file.exists():
-                continue
-            
             with open(file_path, 'r', encoding='utf-8') as f:
-                content = f.read()
-            
-            # Extract KG entities from Gemma
-            kg_data = extract_kg_entities_with_gemma(content, pmc_id)
-            
-            if kg_data is None:
-                skipped_files.append(pmc_id)
-                continue
-            
-            # Add PMC ID to publication if not already there
-            if 'publication' in kg_data:
-                kg_data['publication']['pmc_id'] = pmc_id
-            
-            # Write individual JSON file
-            json_file = output_path / f'{pmc_id}_kg.json'
-            with open(json_file, 'w', encoding='utf-8') as f:
-                json.dump(kg_data, f, indent=2)
-            
-            processed += 1
-            if processed % 5 == 0:
-                print(f"Processed {processed}/{len(txt_files)} files...")
-                time.sleep(2)  # Pause to avoid overwhelming the API
-                
+                papers.append((file_path.stem, f.read()))
         except Exception as e:
             print(f"Error processing {file_path}: {e}")
+    batches = _batches_within_context(papers)
+    
+    # One request per Ollama slot, so no request waits in the server queue
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(extract_kg_entities_for_batch, batch): batch
+                   for batch in batches}
+        
+        # Write JSON files as batches complete
+        for future in as_completed(futures):
+            try:
+                batch_results = future.result()
+            except Exception as e:
+                batch_ids = [pmc_id for pmc_id, _ in futures[future]]
+                print(f"Error processing batch {', '.join(batch_ids)}: {e}")
+                skipped_files.extend(batch_ids)
+                continue
+            
+            for pmc_id, kg_data in batch_results:
+                try:
+                    if kg_data is None:
+                        skipped_files.append(pmc_id)
+                        continue
+                    
+                    # Add PMC ID to publication if not already there
+                    if 'publication' in kg_data:
+                        kg_data['publication']['pmc_id'] = pmc_id
+                    
+                    # Write individual JSON file
+                    json_file = output_path / f'{pmc_id}_kg.json'
+                    with open(json_file, 'wb') as f:
+                        f.write(json_dumps(kg_data))
+                    
+                    processed += 1
+                    if processed % 5 == 0:
+                        print(f"Processed {processed}/{len(txt_files)} files...")
+                        
+                except Exception as e:
+                    print(f"Error processing {pmc_id}: {e}")
     
     print(f"Completed processing {processed} files")
     print(f"JSON files created in {output_path}")
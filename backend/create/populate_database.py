@@ -2,92 +2,132 @@ import json
 import sqlite3
 from pathlib import Path
 
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+# Rows buffered before each executemany + commit during bulk load
+COMMIT_BATCH_ROWS = 10000
+
 class KGStorage:
     def __init__(self, db_path):
         self.db_path = db_path
+        self.conn = sqlite3.connect(db_path)
+        # The DB is rebuilt from JSON, so trade crash-safety for write speed
+        self.conn.executescript("""PRAGMA journal_mode=WAL;
+                                   PRAGMA synchronous=OFF;
+                                   PRAGMA temp_store=MEMORY;
+                                   PRAGMA cache_size=-200000;""")
         self.init_db()
     
     def init_db(self):
-        conn = sqlite3.connect(self.db_path)
-        conn.execute('''CREATE TABLE IF NOT EXISTS triples 
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS triples 
                        (subject TEXT, predicate TEXT, object TEXT)''')
-        conn.commit()
-        conn.close()
+        self.conn.commit()
+    
+    def create_indexes(self):
+        """Build lookup indexes; call after bulk load so inserts skip index maintenance"""
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_subject ON triples(subject)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_subj_pred ON triples(subject, predicate)")
+        self.conn.commit()
     
     def add_triple(self, subject, predicate, obj):
-        conn = sqlite3.connect(self.db_path)
-        conn.execute("INSERT INTO triples VALUES (?, ?, ?)",
+        # Caller is responsible for committing
+        self.conn.execute("INSERT INTO triples VALUES (?, ?, ?)",
                     (subject, predicate, obj))
-        conn.commit()
-        conn.close()
+    
+    def add_triples_bulk(self, rows):
+        """Insert many (subject, predicate, object) rows in one statement"""
+        self.conn.executemany("INSERT INTO triples VALUES (?, ?, ?)", rows)
+    
+    def close(self):
+        self.conn.close()
 
-def populate_kg_from_json(kg_storage, json_data, pmc_id):
-    """Populate knowledge graph from extracted JSON data"""
+def populate_kg_from_json(json_data, pmc_id):
+    """Yield knowledge graph (subject, predicate, object) triples from extracted JSON data"""
     try:
-        # Add publication info
-        if 'publication' in json_data:
-            pub = json_data['publication']
-            kg_storage.add_triple(pmc_id, "has_title", pub.get('title', ''))
-            kg_storage.add_triple(pmc_id, "published_in", pub.get('journal', ''))
-            kg_storage.add_triple(pmc_id, "published_year", pub.get('year', ''))
-        
-        # Add authors
-        if 'authors' in json_data:
-            for author in json_data['authors']:
-                kg_storage.add_triple(pmc_id, "has_author", author)
-        
-        # Add subjects
-        if 'subjects' in json_data:
-            subjects = json_data['subjects']
-            for species in subjects.get('species', []):
-                kg_storage.add_triple(pmc_id, "studies_species", species)
-            for tissue in subjects.get('tissues', []):
-                kg_storage.add_triple(pmc_id, "studies_tissue", tissue)
-        
-        # Add methods
-        if 'methods' in json_data:
-            methods = json_data['methods']
-            for platform in methods.get('platforms', []):
-                kg_storage.add_triple(pmc_id, "uses_platform", platform)
-            for assay in methods.get('assays', []):
-                kg_storage.add_triple(pmc_id, "uses_assay", assay)
-        
-        # Add treatments
-        if 'treatments' in json_data:
-            for i, treatment in enumerate(json_data['treatments']):
-                treatment_id = f"{pmc_id}_treatment_{i}"
-                kg_storage.add_triple(pmc_id, "has_treatment", treatment_id)
-                kg_storage.add_triple(treatment_id, "agent", treatment.get('agent', ''))
-                kg_storage.add_triple(treatment_id, "dose", treatment.get('dose', ''))
-        
-        # Add results
-        if 'results' in json_data:
-            for i, result in enumerate(json_data['results']):
-                result_id = f"{pmc_id}_result_{i}"
-                kg_storage.add_triple(pmc_id, "has_result", result_id)
-                kg_storage.add_triple(result_id, "target", result.get('target', ''))
-                kg_storage.add_triple(result_id, "effect", result.get('effect', ''))
+        for triple in _triples_from_json(json_data, pmc_id):
+            # Reject values SQLite cannot bind here, so one bad file cannot fail a whole batch
+            if not isinstance(triple[2], (str, int, float, type(None))):
+                raise TypeError(f"unsupported {type(triple[2]).__name__} value for {triple[1]}")
+            yield triple
     
     except Exception as e:
         print(f"Error populating KG for {pmc_id}: {e}")
 
+def _triples_from_json(json_data, pmc_id):
+    """Generate raw triples from extracted JSON data"""
+    # Add publication info
+    if 'publication' in json_data:
+        pub = json_data['publication']
+        yield (pmc_id, "has_title", pub.get('title', ''))
+        yield (pmc_id, "published_in", pub.get('journal', ''))
+        yield (pmc_id, "published_year", pub.get('year', ''))
+    
+    # Add authors
+    if 'authors' in json_data:
+        for author in json_data['authors']:
+            yield (pmc_id, "has_author", author)
+    
+    # Add subjects
+    if 'subjects' in json_data:
+        subjects = json_data['subjects']
+        for species in subjects.get('species', []):
+            yield (pmc_id, "studies_species", species)
+        for tissue in subjects.get('tissues', []):
+            yield (pmc_id, "studies_tissue", tissue)
+    
+    # Add methods
+    if 'methods' in json_data:
+        methods = json_data['methods']
+        for platform in methods.get('platforms', []):
+            yield (pmc_id, "uses_platform", platform)
+        for assay in methods.get('assays', []):
+            yield (pmc_id, "uses_assay", assay)
+    
+    # Add treatments
+    if 'treatments' in json_data:
+        for i, treatment in enumerate(json_data['treatments']):
+            treatment_id = f"{pmc_id}_treatment_{i}"
+            yield (pmc_id, "has_treatment", treatment_id)
+            yield (treatment_id, "agent", treatment.get('agent', ''))
+            yield (treatment_id, "dose", treatment.get('dose', ''))
+    
+    # Add results
+    if 'results' in json_data:
+        for i, result in enumerate(json_data['results']):
+            result_id = f"{pmc_id}_result_{i}"
+            yield (pmc_id, "has_result", result_id)
+            yield (result_id, "target", result.get('target', ''))
+            yield (result_id, "effect", result.get('effect', ''))
+
 def process_json_to_database(json_dir, db_path):
     """Process JSON files and populate database"""
     json_path = Path(json_dir)
     kg_storage = KGStorage(db_path)
+    # Only one writer during bulk load
+    kg_storage.conn.execute("PRAGMA locking_mode=EXCLUSIVE")
     
     json_files = list(json_path.glob('PMC*_kg.json'))
     print(f"Processing {len(json_files)} JSON files...")
     
     processed = 0
     
+    # Insert and commit in fixed-size batches to bound memory without a commit per triple
+    batch = []
     for json_file in json_files:
         try:
-            with open(json_file, 'r', encoding='utf-8') as f:
-                json_data = json.load(f)
+            with open(json_file, 'rb') as f:
+                json_data = json_loads(f.read())
             
             pmc_id = json_file.stem.replace('_kg', '')
-            populate_kg_from_json(kg_storage, json_data, pmc_id)
+            batch.extend(populate_kg_from_json(json_data, pmc_id))
+            if len(batch) >= COMMIT_BATCH_ROWS:
+                kg_storage.add_triples_bulk(batch)
+                kg_storage.conn.commit()
+                batch.clear()
             
             processed += 1
             if processed % 10 == 0:
@@ -96,6 +136,14 @@ def process_json_to_database(json_dir, db_path):
         except Exception as e:
             print(f"Error processing {json_file}: {e}")
     
+    if batch:
+        kg_storage.add_triples_bulk(batch)
+    kg_storage.conn.commit()
+    kg_storage.create_indexes()
+    # WAL is persistent; restore rollback journaling so readers need no -wal/-shm files
+    kg_storage.conn.execute("PRAGMA journal_mode=DELETE")
+    kg_storage.close()
+    
     print(f"Completed processing {processed} JSON files")
     print(f"SQLite database created at {db_path}")
 
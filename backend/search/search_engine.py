@@ -1,110 +1,264 @@
 import sqlite3
 import json
+import copy
+import hashlib
+import os
+import tempfile
+import threading
+import joblib
 import requests
+from collections import OrderedDict
 from pathlib import Path
+from requests.adapters import HTTPAdapter
 from sentence_transformers import SentenceTransformer, CrossEncoder
 from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
 import numpy as np
+import torch
+
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+DENSE_MODEL_NAME = 'all-MiniLM-L6-v2'
+CROSS_ENCODER_NAME = 'cross-encoder/ms-marco-MiniLM-L-6-v2'
+# Bump when the on-disk index format changes
+INDEX_CACHE_VERSION = 3
+
+# Cross-encoder reads at most 512 tokens; cap text (~4 chars/token) before tokenizing
+RERANK_MAX_CHARS = 2048
+
+# Triples shown as result metadata, mapped to their result field
+METADATA_PREDICATES = {'has_title': 'title', 'published_in': 'journal', 'published_year': 'year'}
+
+# Pooled HTTP session so summary requests reuse connections to Ollama
+_SESSION = requests.Session()
+_SESSION.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=16))
+
+SUMMARY_FAILED = "Summary generation failed."
+# Entries kept in each of the per-query search and summary caches
+QUERY_CACHE_SIZE = 256
+
+class LRUCache:
+    """Small thread-safe LRU cache; Flask serves requests from multiple threads"""
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key):
+        with self._lock:
+            if key not in self._data:
+                return None
+            self._data.move_to_end(key)
+            return self._data[key]
+    
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
 
 class SearchEngine:
-    def __init__(self, db_path):
+    def __init__(self, db_path, cache_dir=None, quantize_reranker=True):
         self.db_path = db_path
+        self.cache_dir = Path(cache_dir) if cache_dir else Path(__file__).parent / 'cache'
         
         # Load models
-        self.dense_model = SentenceTransformer('all-MiniLM-L6-v2')
-        self.cross_encoder = CrossEncoder('cross-encoder/ms-marco-MiniLM-L-6-v2')
+        self.dense_model = SentenceTransformer(DENSE_MODEL_NAME)
+        self.cross_encoder = CrossEncoder(CROSS_ENCODER_NAME)
+        if quantize_reranker:
+            self._quantize_cross_encoder()
         
-        # Load documents and build indices
+        # Repeated queries skip the whole pipeline, including the Ollama summary
+        self._search_cache = LRUCache(QUERY_CACHE_SIZE)
+        self._summary_cache = LRUCache(QUERY_CACHE_SIZE)
+        
+        # Load documents and build indices, reusing the on-disk cache when the corpus is unchanged
         self.documents = self._load_documents_from_db()
-        self.doc_embeddings = self._build_dense_index()
-        self.tfidf_vectorizer, self.tfidf_matrix = self._build_sparse_index()
+        # Fixed document order shared by the embedding matrix and TF-IDF rows
+        self._doc_ids = tuple(self.documents)
+        self._doc_texts = [self.documents[doc_id]['text'] for doc_id in self._doc_ids]
+        self._id_to_idx = {doc_id: i for i, doc_id in enumerate(self._doc_ids)}
+        cache_key = self._compute_cache_key()
+        if not self._load_index_cache(cache_key):
+            self.doc_embeddings = self._build_dense_index(self._doc_texts)
+            self.tfidf_vectorizer, self.tfidf_matrix = self._build_sparse_index(self._doc_texts)
+            self._save_index_cache(cache_key)
+    
+    def _quantize_cross_encoder(self):
+        """Swap the cross-encoder's Linear layers for dynamic int8 versions on CPU"""
+        model = self.cross_encoder.model
+        if next(model.parameters()).device.type != 'cpu':
+            return
+        try:
+            torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+        except Exception as e:
+            print(f"Cross-encoder quantization failed, using float32: {e}")
     
     def _load_documents_from_db(self):
-        """Load documents from SQLite database"""
+        """Load documents from SQLite database, collecting per-PMC result metadata as well"""
         conn = sqlite3.connect(self.db_path)
         
         # Get all unique PMC IDs
         pmc_ids = conn.execute("SELECT DISTINCT subject FROM triples WHERE subject LIKE 'PMC%'").fetchall()
         
         documents = {}
+        self._metadata = {}
         for (pmc_id,) in pmc_ids:
             # Get all triples for this PMC
             triples = conn.execute("SELECT predicate, object FROM triples WHERE subject = ?", (pmc_id,)).fetchall()
             
             # Build searchable text from triples
             text_parts = []
+            metadata = {'authors': []}
             for predicate, obj in triples:
                 if obj and obj.strip():  # Skip empty values
                     text_parts.append(obj)
+                if predicate == 'has_author':
+                    metadata['authors'].append(obj)
+                elif predicate in METADATA_PREDICATES:
+                    metadata[METADATA_PREDICATES[predicate]] = obj
             
             documents[pmc_id] = {
                 'text': ' '.join(text_parts),
                 'triples': triples
             }
+            self._metadata[pmc_id] = metadata
         
         conn.close()
         return documents
     
-    def _build_dense_index(self):
+    def _compute_cache_key(self):
+        """Hash the model name and document texts so the cache invalidates itself"""
+        digest = hashlib.sha256(f"{DENSE_MODEL_NAME}:{INDEX_CACHE_VERSION}".encode('utf-8'))
+        for pmc_id, text in zip(self._doc_ids, self._doc_texts):
+            digest.update(pmc_id.encode('utf-8'))
+            digest.update(b'\0')
+            digest.update(text.encode('utf-8'))
+            digest.update(b'\0')
+        return digest.hexdigest()
+    
+    def _load_index_cache(self, cache_key):
+        """Load cached embeddings and TF-IDF index; returns False on a miss"""
+        key_file = self.cache_dir / 'cache_key.txt'
+        if not key_file.exists():
+            return False
+        try:
+            if key_file.read_text().strip() != cache_key:
+                return False
+            # Memory-map the embeddings instead of copying them into RAM
+            self.doc_embeddings = np.load(self.cache_dir / 'emb.npy', mmap_mode='r')
+            self.tfidf_vectorizer, self.tfidf_matrix = joblib.load(self.cache_dir / 'tfidf.joblib')
+        except Exception as e:
+            print(f"Index cache unavailable, rebuilding: {e}")
+            return False
+        return True
+    
+    def _save_index_cache(self, cache_key):
+        """Persist embeddings and TF-IDF index for the next startup"""
+        try:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            self._replace_cache_file('emb.npy', lambda f: np.save(f, self.doc_embeddings))
+            self._replace_cache_file('tfidf.joblib',
+                                     lambda f: joblib.dump((self.tfidf_vectorizer, self.tfidf_matrix), f))
+            # Write the key last so a partial save is never treated as valid
+            self._replace_cache_file('cache_key.txt', lambda f: f.write(cache_key.encode('utf-8')))
+        except Exception as e:
+            print(f"Error saving index cache: {e}")
+    
+    def _replace_cache_file(self, name, write):
+        """Write a cache file via a temp file and atomic rename"""
+        # A running server may have emb.npy memory-mapped; truncating it in place
+        # would crash that process, while a rename leaves its mapping intact
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, prefix=f'.{name}.')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                write(f)
+            os.replace(tmp_path, self.cache_dir / name)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+    
+    def _build_dense_index(self, texts):
         """Build dense embeddings for all documents"""
-        texts = [doc['text'] for doc in self.documents.values()]
-        embeddings = self.dense_model.encode(texts)
-        return embeddings
+        # Unit-length vectors make cosine a plain dot product; keep float32 so the
+        # matvec goes through BLAS (NumPy has no BLAS path for float16)
+        embeddings = self.dense_model.encode(texts, batch_size=64, show_progress_bar=False,
+                                             convert_to_numpy=True, normalize_embeddings=True)
+        return np.ascontiguousarray(embeddings, dtype=np.float32)
     
-    def _build_sparse_index(self):
+    def _build_sparse_index(self, texts):
         """Build TF-IDF sparse index"""
-        texts = [doc['text'] for doc in self.documents.values()]
-        vectorizer = TfidfVectorizer(max_features=10000, stop_words='english')
-        tfidf_matrix = vectorizer.fit_transform(texts)
+        # norm='l2' (the default) stores unit-length CSR rows, so cosine is a plain dot product
+        vectorizer = TfidfVectorizer(max_features=10000, stop_words='english', norm='l2')
+        tfidf_matrix = vectorizer.fit_transform(texts).tocsr()
         return vectorizer, tfidf_matrix
     
+    def _top_k(self, similarities, top_k):
+        """Return the top_k (doc_id, score) pairs using partial selection instead of a full sort"""
+        k = min(top_k, len(similarities))
+        if k == 0:
+            return []
+        # argpartition is not stable, so widen to every doc tied with the k-th score
+        kth_score = similarities[np.argpartition(-similarities, k - 1)[k - 1]]
+        top_idx = np.flatnonzero(similarities >= kth_score)
+        # Sort by score, ties by corpus index, matching a stable full sort
+        top_idx = top_idx[np.lexsort((top_idx, -similarities[top_idx]))][:k]
+        return [(self._doc_ids[i], float(similarities[i])) for i in top_idx]
+    
     def sparse_search(self, query, top_k=50):
         """BM25-style sparse search using TF-IDF"""
+        # Query vector is L2-normalized by the vectorizer as well
         query_vec = self.tfidf_vectorizer.transform([query])
-        similarities = cosine_similarity(query_vec, self.tfidf_matrix).flatten()
-        
-        doc_ids = list(self.documents.keys())
-        results = [(doc_ids[i], similarities[i]) for i in range(len(doc_ids))]
-        results.sort(key=lambda x: x[1], reverse=True)
+        similarities = (self.tfidf_matrix @ query_vec.T).toarray().ravel()
         
-        return results[:top_k]
+        return self._top_k(similarities, top_k)
     
     def dense_search(self, query, top_k=50):
         """Dense embedding search"""
-        query_embedding = self.dense_model.encode([query])
-        similarities = cosine_similarity(query_embedding, self.doc_embeddings).flatten()
-        
-        doc_ids = list(self.documents.keys())
-        results = [(doc_ids[i], similarities[i]) for i in range(len(doc_ids))]
-        results.sort(key=lambda x: x[1], reverse=True)
+        query_embedding = self.dense_model.encode([query], normalize_embeddings=True)[0]
+        similarities = self.doc_embeddings @ query_embedding.astype(np.float32)
         
-        return results[:top_k]
+        return self._top_k(similarities, top_k)
     
     def reciprocal_rank_fusion(self, rankings, k=60):
         """Combine multiple rankings using RRF"""
-        scores = {}
+        # Accumulate scores by document index instead of in a dict
+        scores = np.zeros(len(self._doc_ids))
+        ranking_idxs = []
         for ranking in rankings:
-            for rank, (doc_id, _) in enumerate(ranking):
-                if doc_id not in scores:
-                    scores[doc_id] = 0
-                scores[doc_id] += 1 / (k + rank + 1)
+            if not ranking:
+                continue
+            idxs = np.fromiter((self._id_to_idx[doc_id] for doc_id, _ in ranking),
+                               dtype=np.intp, count=len(ranking))
+            scores[idxs] += 1.0 / (k + np.arange(len(ranking)) + 1)
+            ranking_idxs.append(idxs)
         
-        return sorted(scores.items(), key=lambda x: x[1], reverse=True)
+        if not ranking_idxs:
+            return []
+        # Candidates in order of first appearance, so the stable sort breaks ties the same way
+        all_idxs = np.concatenate(ranking_idxs)
+        _, first_pos = np.unique(all_idxs, return_index=True)
+        candidates = all_idxs[np.sort(first_pos)]
+        candidates = candidates[np.argsort(-scores[candidates], kind='stable')]
+        return [(self._doc_ids[i], float(scores[i])) for i in candidates]
     
-    def cross_encoder_rerank(self, query, candidates, top_k=10):
+    def cross_encoder_rerank(self, query, candidates, top_k=10, max_candidates=20):
         """Re-rank candidates using cross-encoder"""
-        pairs = []
-        doc_ids = []
-        
-        for doc_id, _ in candidates[:20]:  # Only rerank top 20
-            pairs.append((query, self.documents[doc_id]['text']))
-            doc_ids.append(doc_id)
-        
-        if not pairs:
+        doc_ids = [doc_id for doc_id, _ in candidates[:max_candidates]]
+        if not doc_ids:
             return []
         
-        scores = self.cross_encoder.predict(pairs)
+        # Pre-truncate so one long document cannot inflate the padded batch shape
+        pairs = [(query, self._doc_texts[self._id_to_idx[doc_id]][:RERANK_MAX_CHARS])
+                 for doc_id in doc_ids]
+        
+        # Score all pairs in batches rather than one forward pass per pair
+        scores = self.cross_encoder.predict(pairs, batch_size=32, convert_to_numpy=True,
+                                            show_progress_bar=False)
         results = list(zip(doc_ids, scores))
         results.sort(key=lambda x: x[1], reverse=True)
         
@@ -112,6 +266,12 @@ class SearchEngine:
     
     def search(self, query, top_k=10, include_summary=True):
         """Complete search pipeline with optional summary"""
+        cache_key = (query, top_k, include_summary)
+        cached = self._search_cache.get(cache_key)
+        if cached is not None:
+            # Callers may mutate the response, so hand out a copy
+            return copy.deepcopy(cached)
+        
         # 1. Sparse and dense search
         sparse_results = self.sparse_search(query, top_k=50)
         dense_results = self.dense_search(query, top_k=50)
@@ -124,23 +284,14 @@ class SearchEngine:
         
         # 4. Filter by score threshold and format results
         formatted_results = []
-        conn = sqlite3.connect(self.db_path)
         for doc_id, score in final_results:
             # Skip results with very low relevance scores
             if score < -2.0:
                 continue
             # Extract parent PMC ID if this is a sub-entity
-            parent_pmc = doc_id.split('_')[0] if '_' in doc_id else doc_id
-            
-            # Get metadata from parent PMC
-            metadata = conn.execute("SELECT predicate, object FROM triples WHERE subject = ? AND predicate IN ('has_title', 'published_in', 'published_year', 'has_author')", (parent_pmc,)).fetchall()
-            metadata_dict = {}
-            authors_list = []
-            for pred, obj in metadata:
-                if pred == 'has_author':
-                    authors_list.append(obj)
-                else:
-                    metadata_dict[pred] = obj
+            parent_pmc = doc_id.split('_')[0]
+            metadata = self._metadata.get(parent_pmc, {})
+            authors_list = metadata.get('authors', [])
             
             # Format authors
             author_str = ', '.join(authors_list[:3])  # Show first 3 authors
@@ -149,19 +300,22 @@ class SearchEngine:
             
             formatted_results.append({
                 'pmc_id': parent_pmc,
-                'title': metadata_dict.get('has_title', 'Unknown Title'),
-                'journal': metadata_dict.get('published_in', 'Unknown Journal'),
-                'year': metadata_dict.get('published_year', 'Unknown Year'),
+                'title': metadata.get('title', 'Unknown Title'),
+                'journal': metadata.get('journal', 'Unknown Journal'),
+                'year': metadata.get('year', 'Unknown Year'),
                 'authors': author_str if author_str else 'Unknown Authors',
                 'score': float(score)
             })
-        conn.close()
         
         # 5. Generate summary if requested
         response = {'results': formatted_results}
         if include_summary:
             response['summary'] = self.generate_summary(query, formatted_results)
         
+        # Don't pin a failed summary in the cache; retry it on the next request
+        if response.get('summary') != SUMMARY_FAILED:
+            self._search_cache.put(cache_key, copy.deepcopy(response))
+        
         return response
     
     def generate_summary(self, query, results):
@@ -169,6 +323,12 @@ class SearchEngine:
         if not results:
             return "No relevant results found."
         
+        # Key on the set of cited papers so reordering among them reuses the summary
+        cache_key = (query, tuple(sorted(result['pmc_id'] for result in results[:5])))
+        cached = self._summary_cache.get(cache_key)
+        if cached is not None:
+            return cached
+        
         # Format results for prompt
         results_text = ""
         for i, result in enumerate(results[:5], 1):  # Top 5 results
@@ -184,7 +344,7 @@ class SearchEngine:
 Summary:"""
         
         try:
-            response = requests.post('http://localhost:11434/api/generate',
+            response = _SESSION.post('http://localhost:11434/api/generate',
                                    json={
                                        'model': 'gemma2:2b',
                                        'prompt': prompt,
@@ -197,13 +357,15 @@ Summary:"""
                                    timeout=30)
             
             if response.status_code == 200:
-                result = response.json()
-                return result.get('response', '').strip()
+                result = json_loads(response.content)
+                summary = result.get('response', '').strip()
+                self._summary_cache.put(cache_key, summary)
+                return summary
         
         except Exception as e:
             print(f"Error generating summary: {e}")
         
-        return "Summary generation failed."
+        return SUMMARY_FAILED
 
 def main():
     # Initialize search engine